@@ -1,11 +1,13 @@
 #!/usr/bin/env python3
 import client
 
+import sys
+
 LOGIN_URL = 'https://login.microsoftonline.com/common/oauth2/v2.0/authorize'
 
 
-def login():
-    cl = client.Client()
+def login(profile=client.DEFAULT_PROFILE):
+    cl = client.Client(profile)
     oauth = cl.oauth
     oauth.redirect_uri = cl.config['redirect_uri']
     authorization_url, state = oauth.authorization_url(LOGIN_URL)
@@ -17,4 +19,7 @@ def login():
 
 
 if __name__ == '__main__':
-    login()
+    if len(sys.argv) > 1:
+        login(sys.argv[1])
+    else:
+        login()
@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""Microbenchmarks for the conversions we do for every item."""
+import client
+import database
+
+import timeit
+
+SAMPLE_JSON = {
+    'id': '0123456789ABCDEF!123',
+    'name': 'example.bin',
+    'size': 123456,
+    'file': {'hashes': {'quickXorHash': 'AAAAAAAAAAAAAAAAAAAAAAAAAAA='}},
+    'fileSystemInfo': {
+        'lastModifiedDateTime': '2020-05-01T10:20:30.123Z',
+    },
+}
+SAMPLE_ROW = ('0123456789ABCDEF!123', 'example.bin', '/tmp/example.bin', 1,
+              0, 123456, 1588328430.123, 'AAAAAAAAAAAAAAAAAAAAAAAAAAA=',
+              '0123456789ABCDEF!100')
+
+
+def run(name, stmt, number=100000):
+    best = min(timeit.repeat(stmt, number=number, repeat=5))
+    print('{:<16} {:8.3f} us/call'.format(name, best / number * 1e6))
+
+
+def main():
+    item = database.record_to_item(SAMPLE_ROW)
+    run('json_to_item', lambda: client.json_to_item(SAMPLE_JSON))
+    run('record_to_item', lambda: database.record_to_item(SAMPLE_ROW))
+    run('item_to_tuple', lambda: database.item_to_tuple(item))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,37 +1,78 @@
+import database
 import models
 
 import dateutil.parser
 import dateutil.tz
+from quickxorhash import quickxorhash
+import requests
+from requests.adapters import HTTPAdapter
 from requests_oauthlib import OAuth2Session
 
 from datetime import datetime
+import base64
+import calendar
 import json
 import logging
 import os
 import os.path
 import time
 
-# The file where we will save the token
+# The file with the configuration of the app and of the profiles
+CONFIG_FILE = 'config.json'
+# The profile used when the configuration does not define any
+DEFAULT_PROFILE = 'default'
+# The file where we will save the token (of the default profile)
 TOKEN_FILE = 'token.json'
 # The URL to use to fetch and to renew the token
 TOKEN_URL = 'https://login.microsoftonline.com/common/oauth2/v2.0/token'
 # The scopes we need for our app
 SCOPES = ['User.Read', 'offline_access', 'Files.Read', 'Files.Read.All',
           'Files.ReadWrite', 'Files.ReadWrite.All']
-# The base URL for OneDrive requests
+# The base URL for OneDrive requests (to the drive of the user)
 DRIVE_URL = 'https://graph.microsoft.com/v1.0/me/drive/'
+# The base URL for requests to a specific drive
+DRIVES_URL = 'https://graph.microsoft.com/v1.0/drives/{}/'
 
 logger = logging.getLogger(__name__)
 
 
 def date_from_onedrive(datestring):
-    return dateutil.parser.parse(datestring)
+    """Convert a OneDrive date to seconds since the epoch.
+
+    OneDrive always uses the YYYY-MM-DDTHH:MM:SS[.fff]Z format, so we
+    slice it directly, and fall back to dateutil only for anything else.
+    """
+    try:
+        if datestring[10] != 'T' or datestring[-1] != 'Z':
+            raise ValueError(datestring)
+        seconds = calendar.timegm((
+            int(datestring[0:4]), int(datestring[5:7]),
+            int(datestring[8:10]), int(datestring[11:13]),
+            int(datestring[14:16]), int(datestring[17:19])))
+        if len(datestring) > 20:
+            if datestring[19] != '.':
+                raise ValueError(datestring)
+            seconds += float(datestring[19:-1])
+        return float(seconds)
+    except (ValueError, IndexError):
+        return dateutil.parser.parse(datestring).timestamp()
 
 
 def date_to_onedrive(dt):
     return dt.astimezone(dateutil.tz.UTC).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
 
 
+def times_from_stat(stat):
+    ctime = datetime.fromtimestamp(stat.st_ctime)
+    mtime = datetime.fromtimestamp(stat.st_mtime)
+    return {
+        'fileSystemInfo': {
+            'createdDateTime': date_to_onedrive(ctime),
+            'lastModifiedDateTime': date_to_onedrive(mtime),
+        }
+    }
+
+
 def json_to_item(obj, parent_id=None):
     kwargs = {
         'onedrive_id': obj['id'],
@@ -59,27 +100,82 @@ def json_to_item(obj, parent_id=None):
     return models.Item(**kwargs)
 
 
+def load_config():
+    try:
+        with open(CONFIG_FILE) as f:
+            return json.load(f)
+    except FileNotFoundError as e:
+        logger.exception('Configuration not found', exc_info=e)
+        raise e
+
+
+def get_profiles(config):
+    """Return the configuration of each profile.
+
+    Every profile mirrors its directories to a drive, with its own token
+    file and database. The app settings (client_id, etc.) are shared.
+    Without a profiles section, the configuration has a single profile,
+    which uses the default files and the drive of the user.
+    """
+    if 'profiles' not in config:
+        return {DEFAULT_PROFILE: {
+            'token_file': TOKEN_FILE,
+            'database': database.DB_FILE,
+            'synchronize': config['synchronize'],
+        }}
+
+    profiles = {}
+    for name, profile in config['profiles'].items():
+        profiles[name] = {
+            'token_file': 'token-{}.json'.format(name),
+            'database': 'items-{}.db'.format(name),
+        }
+        profiles[name].update(profile)
+    return profiles
+
+
+def make_adapter(pool_size=10):
+    """Create an adapter to share a connection pool among clients."""
+    return HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+
+
 class ThrottleError(Exception):
-    def __init__(self, retry_after):
+    def __init__(self, retry_after, next_link=None):
         self.retry_after = float(retry_after)
+        # The page to resume from, when listing children
+        self.next_link = next_link
 
     def sleep(self):
         time.sleep(self.retry_after)
 
 
+class CopyPending(Exception):
+    def __init__(self, monitor_url):
+        self.monitor_url = monitor_url
+
+
 class Client:
-    def __init__(self):
-        self.config = {}
-        try:
-            with open('config.json') as f:
-                self.config = json.load(f)
-        except FileNotFoundError as e:
-            logger.exception('Configuration not found', exc_info=e)
-            raise e
+    def __init__(self, profile=DEFAULT_PROFILE, adapter=None):
+        config = load_config()
+        profiles = get_profiles(config)
+        if profile not in profiles:
+            raise KeyError('Unknown profile {}'.format(profile))
+        self.profile = profile
+        # Keep everything in a single dictionary, with the settings of the
+        # profile overriding the global ones
+        self.config = dict(config)
+        self.config.pop('profiles', None)
+        self.config.update(profiles[profile])
+
+        self.token_file = self.config['token_file']
+        if self.config.get('drive_id'):
+            self.drive_url = DRIVES_URL.format(self.config['drive_id'])
+        else:
+            self.drive_url = DRIVE_URL
 
         # First, try to use an existing token
         try:
-            with open(TOKEN_FILE) as f:
+            with open(self.token_file) as f:
                 token = json.load(f)
                 token['expires_in'] = time.time() - token['expires_at']
         except FileNotFoundError as e:
@@ -99,39 +195,85 @@ class Client:
             client_id=self.config['client_id'], scope=SCOPES, token=token,
             auto_refresh_url=TOKEN_URL, auto_refresh_kwargs=refresh_extra,
             token_updater=self.token_saver)
-        logger.info('Oauth client ready')
+        # The copy monitors do not need (nor accept) authentication, so
+        # they use a plain session, sharing the connections anyway
+        self.monitor = requests.Session()
+        if adapter is not None:
+            self.oauth.mount('https://', adapter)
+            self.monitor.mount('https://', adapter)
+        logger.info('Oauth client for profile %s ready', profile)
 
     def token_saver(self, token):
-        with open(TOKEN_FILE, 'w') as f:
+        with open(self.token_file, 'w') as f:
             logger.debug('Saving refreshed token')
             json.dump(token, f)
             f.write('\n')
 
     def get_drives(self):
-        r = self.oauth.get(DRIVE_URL + 'root')
+        r = self.oauth.get(self.drive_url + 'root')
         if r.status_code == 200:
             return r.json()
 
-    def get_children(self, parent_id):
-        select = '?select=id,name,file,folder,size,fileSystemInfo'
-        url = '{}items/{}/children{}'.format(DRIVE_URL, parent_id, select)
-        children = []
+    def get_children_pages(self, parent_id, next_link=None, attempts=5):
+        """Yield the children of an item a page at a time, together with
+        the link to the following page.
+
+        After a ThrottleError, pass its next_link to resume from where we
+        stopped, without fetching the previous pages again. Server errors
+        are retried attempts times on the same page.
+        """
+        if next_link:
+            url = next_link
+        else:
+            select = '?select=id,name,file,folder,size,fileSystemInfo'
+            url = '{}items/{}/children{}'.format(
+                self.drive_url, parent_id, select)
+        failures = 0
         while url:
             r = self.oauth.get(url)
             if r.status_code == 429:
-                raise ThrottleError(r.headers['Retry-After'])
+                raise ThrottleError(r.headers['Retry-After'], url)
+            if r.status_code >= 500 and failures < attempts:
+                failures += 1
+                delay = float(r.headers.get('Retry-After', 2 ** failures))
+                logger.warning('Server error %d while getting the children '
+                               'of item %s, retrying in %ds', r.status_code,
+                               parent_id, delay)
+                time.sleep(delay)
+                continue
+            if r.status_code == 404:
+                # Deleted in the meantime, so it does not have children
+                logger.info('Item %s not found while getting its children',
+                            parent_id)
+                return
             if r.status_code != 200:
                 logger.error('Could not get the children of item %s. '
-                             'URL=%s Status=%d, response=%s', url, parent_id,
+                             'URL=%s Status=%d, response=%s', parent_id, url,
                              r.status_code, r.text)
-                break
+                # Do not return partial results, the caller might think
+                # that the other children do not exist anymore
+                r.raise_for_status()
             data = r.json()
-            children += [json_to_item(obj) for obj in data['value']]
             url = data.get('@odata.nextLink', '')
-        return children
+            failures = 0
+            page = [json_to_item(obj) for obj in data['value']]
+            yield [item for item in page if item is not None], url
+
+    def get_item(self, item_id):
+        """Return the item with the given ID, or None if it does not
+        exist anymore."""
+        select = '?select=id,name,file,folder,size,fileSystemInfo'
+        url = '{}items/{}{}'.format(self.drive_url, item_id, select)
+        r = self.oauth.get(url)
+        if r.status_code == 429:
+            raise ThrottleError(r.headers['Retry-After'])
+        if r.status_code == 404:
+            return None
+        r.raise_for_status()
+        return json_to_item(r.json())
 
     def get_item_by_path(self, path):
-        url = '{}root:/{}'.format(DRIVE_URL, path)
+        url = '{}root:/{}'.format(self.drive_url, path)
         r = self.oauth.get(url)
         data = r.json()
         if r.status_code != 200:
@@ -142,7 +284,8 @@ class Client:
         return json_to_item(data)
 
     def create_folder(self, parent_id, name):
-        create_url = '{}items/{}/children'.format(DRIVE_URL, parent_id)
+        create_url = '{}items/{}/children'.format(
+            self.drive_url, parent_id)
         create_obj = {
             'name': name,
             'folder': {},
@@ -169,7 +312,7 @@ class Client:
 
     def delete_item(self, item_id):
         logger.debug('Deleting item', item_id)
-        del_url = '{}items/{}'.format(DRIVE_URL, item_id)
+        del_url = '{}items/{}'.format(self.drive_url, item_id)
         r = self.oauth.delete(del_url)
 
         if r.status_code == 429:
@@ -188,28 +331,33 @@ class Client:
             return False
         return True
 
-    def upload(self, source_filename, target, parent_id, target_is_id=True):
+    def upload(self, source_filename, target, parent_id, target_is_id=True,
+               attempts=3):
+        """Upload a file, and check that OneDrive received the same
+        content we read.
+
+        The hash is computed while we send the file, so it does not cost
+        an additional read. If it does not match the one returned by
+        OneDrive, we upload the file again, up to attempts times, and then
+        we return the item with None as hash.
+
+        Return the item and whether OneDrive confirmed its hash, or None
+        and False if the upload failed.
+        """
         if target_is_id:
             create_url = '{}items/{}/createUploadSession'.format(
-                DRIVE_URL, target)
+                self.drive_url, target)
         else:
             create_url = '{}root:/{}:/createUploadSession'.format(
-                DRIVE_URL, target)
+                self.drive_url, target)
 
         stat = os.stat(source_filename)
-        ctime = datetime.fromtimestamp(stat.st_ctime)
-        mtime = datetime.fromtimestamp(stat.st_mtime)
 
         if stat.st_size == 0:
             logger.warning('Ignoring empty file %s', source_filename)
-            return None
+            return None, False
 
-        times = {
-            'fileSystemInfo': {
-                'createdDateTime': date_to_onedrive(ctime),
-                'lastModifiedDateTime': date_to_onedrive(mtime),
-            }
-        }
+        times = times_from_stat(stat)
         if target_is_id:
             obj = {'item': times}
         else:
@@ -222,33 +370,61 @@ class Client:
             logger.error(
                 'Cannot create the upload session. Status=%d, response=%s',
                 r.status_code, r.text)
-            return None
+            return None, False
         data = r.json()
         upload_url = data['uploadUrl']
 
         chunk_size = 10485760  # 10 MiB, multiple of 320 KiB
         sent = 0
+        h = quickxorhash()
         with open(source_filename, 'rb') as f:
             while sent < stat.st_size:
                 upper = min(stat.st_size, sent + chunk_size)
                 crange = 'bytes {}-{}/{}'.format(sent, upper - 1, stat.st_size)
                 buffer = f.read(upper - sent)
+                h.update(buffer)
                 r = self.oauth.put(upload_url, buffer,
                                    headers={'Content-Range': crange})
                 if r.status_code not in (200, 201, 202):
                     logger.error(
                         'Cannot upload chunk %d. Status=%d, response=%s',
                         sent, r.status_code, r.text)
-                    return None
+                    return None, False
                 sent = upper
 
         item = json_to_item(r.json(), parent_id)
         item.original_path = source_filename
 
+        hash_ = base64.b64encode(h.digest()).decode()
+        verified = item.hash == hash_
+        if item.hash is None:
+            # Keep the local hash, but leave the file to the verification
+            logger.debug('OneDrive did not return the hash of %s',
+                         source_filename)
+            item.hash = hash_
+        elif item.hash != hash_:
+            logger.warning('Hash mismatch after uploading %s (local=%s, '
+                           'remote=%s)', source_filename, hash_, item.hash)
+            retried = None
+            if attempts > 1:
+                # The file exists now, so upload to its ID, to avoid
+                # creating a renamed copy
+                retried, verified = self.upload(
+                    source_filename, item.onedrive_id, parent_id, True,
+                    attempts - 1)
+            if retried is not None:
+                return retried, verified
+            # The item exists anyway, so return it to keep track of it,
+            # but without a hash: it tells that it is not verified, and
+            # the hash verification will upload it again
+            logger.error('Could not verify the upload of %s',
+                         source_filename)
+            item.hash = None
+
         if not target_is_id:
             # Set the times after the creation (see above)
             patch_url = '{}items/{}/createUploadSession'.format(
-                DRIVE_URL, item.onedrive_id)
+                self.drive_url, item.onedrive_id)
             r = self.oauth.patch(patch_url, json=times)
             if r.status_code != 200:
                 logger.warning(
@@ -256,4 +432,118 @@ class Client:
                     'file (id=%s, status=%d, response=%s)', item.onedrive_id,
                     r.status_code, r.text)
 
+        return item, verified
+
+    def copy(self, source_filename, source_id, parent_id, name, wait=True):
+        """Copy an item with the same content of source_filename on the
+        server, to avoid uploading it again.
+
+        Without wait, raise CopyPending as soon as the copy starts.
+        """
+        # Like uploads, rename on conflicts, otherwise the copy would fail
+        # only after we waited for it
+        copy_url = ('{}items/{}/copy'
+                    '?@microsoft.graph.conflictBehavior=rename').format(
+                        self.drive_url, source_id)
+        copy_obj = {
+            'parentReference': {'id': parent_id},
+            'name': name,
+        }
+        r = self.oauth.post(copy_url, json=copy_obj)
+
+        if r.status_code == 429:
+            logger.debug('Sleeping during copy')
+            time.sleep(float(r.headers['Retry-After']))
+            return self.copy(source_filename, source_id, parent_id, name,
+                             wait)
+
+        if r.status_code != 202:
+            logger.info(
+                'Could not copy item %s to %s. Status=%d, response=%s',
+                source_id, name, r.status_code, r.text)
+            return None
+
+        if not wait:
+            raise CopyPending(r.headers['Location'])
+        new_id = self.wait_copy(r.headers['Location'])
+        if new_id is None:
+            return None
+        return self.finish_copy(source_filename, new_id, parent_id)
+
+    def finish_copy(self, source_filename, new_id, parent_id):
+        """Return the item created by a copy, after setting its times."""
+        # The copy keeps the times of the original, but we compare them
+        # with the local ones
+        times = times_from_stat(os.stat(source_filename))
+        patch_url = '{}items/{}'.format(self.drive_url, new_id)
+        r = self.oauth.patch(patch_url, json=times)
+        if r.status_code != 200:
+            logger.warning(
+                'Could not set the correct times to the copied file '
+                '(id=%s, status=%d, response=%s)', new_id, r.status_code,
+                r.text)
+            # Leave it to the next comparison, which will upload the file
+            r = self.oauth.get(patch_url)
+            if r.status_code != 200:
+                return None
+
+        item = json_to_item(r.json(), parent_id)
+        item.original_path = source_filename
         return item
+
+    def check_copy(self, monitor_url):
+        """Check the monitor of an asynchronous copy.
+
+        Return the status (inProgress, completed, failed, or unknown if
+        the monitor is not available anymore) and the ID of the new item.
+        """
+        r = self.monitor.get(monitor_url, allow_redirects=False)
+        if r.status_code == 429:
+            raise ThrottleError(r.headers['Retry-After'])
+        if r.status_code not in (200, 202, 303):
+            logger.error('Could not get the copy status. Status=%d, '
+                         'response=%s', r.status_code, r.text)
+            return 'unknown', None
+        try:
+            data = r.json()
+        except ValueError:
+            data = {}
+        if r.status_code == 303 and 'resourceId' not in data:
+            # Redirect to the new item
+            new_id = r.headers['Location'].rstrip('/').split('/')[-1]
+            return 'completed', new_id
+        status = data.get('status')
+        if status == 'completed':
+            return status, data.get('resourceId')
+        if status == 'failed':
+            logger.error('Copy failed, response=%s', r.text)
+            return status, None
+        return 'inProgress', None
+
+    def wait_copy(self, monitor_url, timeout=600):
+        """Poll the monitor of an asynchronous copy, and return the ID of
+        the new item, or None if the copy failed.
+
+        Raise CopyPending if the copy is still in progress after timeout
+        seconds, or if we cannot get its status, because it might still
+        complete later.
+        """
+        deadline = time.monotonic() + timeout
+        poll = 1
+        while time.monotonic() < deadline:
+            try:
+                status, new_id = self.check_copy(monitor_url)
+            except ThrottleError as e:
+                poll = e.retry_after
+                status = 'inProgress'
+            if status == 'completed':
+                return new_id
+            if status == 'failed':
+                return None
+            if status == 'unknown':
+                # We cannot tell whether the copy happened
+                raise CopyPending(monitor_url)
+            time.sleep(poll)
+            poll = min(poll * 2, 30)
+        logger.warning('Timed out while waiting for copy %s', monitor_url)
+        raise CopyPending(monitor_url)
@@ -1,8 +1,8 @@
 import models
 
-from datetime import datetime
 import logging
 import sqlite3
+import time
 
 DB_FILE = 'items.db'
 
@@ -10,46 +10,61 @@ logger = logging.getLogger(__name__)
 
 
 def record_to_item(row):
-    data = {
-        'onedrive_id': row[0],
-        'name': row[1],
-        'original_path': row[2],
-        'existing': row[3],
-        'parent_id': row[8],
-    }
-    if bool(row[4]):
-        data['is_folder'] = True
-    else:
-        data['is_folder'] = False
-        data['size'] = row[5]
-        data['mdate'] = datetime.fromtimestamp(float(row[6]))
-        data['hash'] = row[7]
-
-    return models.Item(**data)
+    # Rows and items share the same field order, and mdate is stored as
+    # seconds since the epoch, exactly like we keep it in items
+    if row[4]:
+        return models.Item(row[0], row[1], row[2], row[3], True, 0, 0, None,
+                           row[8])
+    return models.Item(row[0], row[1], row[2], row[3], False, row[5],
+                       row[6], row[7], row[8])
 
 
 def item_to_tuple(item, id_as_last=False):
-    lst = list(item)
     if item.is_folder:
-        lst[4] = 1
-        lst[5] = 0
-        lst[6] = 0
-        lst[7] = None
+        values = (item.name, item.original_path, item.existing, 1, 0, 0,
+                  None, item.parent_id)
     else:
-        lst[4] = 0
-        lst[6] = lst[6].timestamp()
+        values = (item.name, item.original_path, item.existing, 0,
+                  item.size, item.mdate, item.hash, item.parent_id)
     if id_as_last:
-        lst.append(lst.pop(0))
-    return tuple(lst)
+        return values + (item.onedrive_id,)
+    return (item.onedrive_id,) + values
 
 
 class Database:
 
-    def __init__(self):
-        self.db = sqlite3.connect(DB_FILE)
+    def __init__(self, filename=DB_FILE):
+        self.db = sqlite3.connect(filename)
+        self.upgrade_schema()
+
+    def upgrade_schema(self):
+        cur = self.db.cursor()
+        cur.execute('PRAGMA table_info(item)')
+        columns = [row[1] for row in cur.fetchall()]
+        if not columns:
+            return
+        if 'hash_checked' not in columns:
+            logger.info('Adding the hash_checked column to the database')
+            cur.execute('ALTER TABLE item ADD COLUMN '
+                        'hash_checked REAL DEFAULT 0 NOT NULL')
+        cur.execute('CREATE INDEX IF NOT EXISTS hash_checked '
+                    'ON item(hash_checked)')
+        cur.execute('CREATE INDEX IF NOT EXISTS contents ON item(size, hash)')
+        cur.execute('CREATE TABLE IF NOT EXISTS journal ('
+                    'id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                    'operation TEXT NOT NULL, onedrive_id TEXT, '
+                    'parent_id TEXT, original_path TEXT, '
+                    'started REAL NOT NULL, outcome TEXT, '
+                    'monitor_url TEXT, attempts INTEGER DEFAULT 0 NOT NULL)')
+        cur.execute('CREATE INDEX IF NOT EXISTS pending ON journal(outcome)')
+        cur.execute('CREATE TABLE IF NOT EXISTS maintenance ('
+                    'task TEXT PRIMARY KEY, last REAL NOT NULL)')
+        self.db.commit()
 
     def add_item(self, item):
-        query = 'INSERT INTO item VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+        query = ('INSERT INTO item (onedrive_id, onedrive_name, '
+                 'original_path, existing, is_folder, size, mdate, hash, '
+                 'parent_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)')
         cur = self.db.cursor()
         try:
             cur.execute(query, item_to_tuple(item))
@@ -75,6 +90,14 @@ class Database:
         else:
             self.add_item(item)
 
+    def get_item(self, onedrive_id):
+        cur = self.db.cursor()
+        cur.execute('SELECT * FROM item WHERE onedrive_id = ?',
+                    (onedrive_id,))
+        row = cur.fetchone()
+        if row:
+            return record_to_item(row)
+
     def delete_items(self, items):
         to_delete = []
         for i in items:
@@ -109,6 +132,121 @@ class Database:
         if row:
             return record_to_item(row)
 
+    def has_size(self, size):
+        cur = self.db.cursor()
+        cur.execute('SELECT 1 FROM item WHERE size = ? AND is_folder = 0 '
+                    'LIMIT 1', (size,))
+        return cur.fetchone() is not None
+
+    def get_by_contents(self, size, hash_):
+        cur = self.db.cursor()
+        cur.execute('SELECT * FROM item WHERE size = ? AND hash = ? '
+                    'AND is_folder = 0', (size, hash_))
+        return [record_to_item(row) for row in cur.fetchall()]
+
+    def get_hash_candidates(self, max_bytes, prioritize_modified=False):
+        """Return the IDs of the files to verify in this cycle.
+
+        Files verified less recently come first, and we stop when their
+        total size exceeds max_bytes (at least one file is always
+        returned, if any). With prioritize_modified, the files modified
+        after their last verification take precedence.
+        """
+        query = 'SELECT onedrive_id, size FROM item WHERE is_folder = 0 '
+        if prioritize_modified:
+            query += 'ORDER BY mdate > hash_checked DESC, hash_checked'
+        else:
+            query += 'ORDER BY hash_checked'
+        cur = self.db.cursor()
+        cur.execute(query)
+        candidates = set()
+        total = 0
+        for onedrive_id, size in cur:
+            if candidates and total + size > max_bytes:
+                break
+            candidates.add(onedrive_id)
+            total += size
+        return candidates
+
+    def get_total_size(self):
+        cur = self.db.cursor()
+        cur.execute('SELECT SUM(size) FROM item WHERE is_folder = 0')
+        return cur.fetchone()[0] or 0
+
+    def mark_hash_checked(self, item, when):
+        cur = self.db.cursor()
+        cur.execute('UPDATE item SET hash_checked = ? WHERE onedrive_id = ?',
+                    (when, item.onedrive_id))
+
+    def journal_begin(self, operation, onedrive_id=None, parent_id=None,
+                      original_path=None):
+        """Record an operation we are going to do on OneDrive.
+
+        This commits, together with any pending change, so that the entry
+        survives a crash during the remote operation.
+        """
+        cur = self.db.cursor()
+        cur.execute('INSERT INTO journal (operation, onedrive_id, parent_id, '
+                    'original_path, started) VALUES (?, ?, ?, ?, ?)',
+                    (operation, onedrive_id, parent_id, original_path,
+                     time.time()))
+        self.db.commit()
+        return cur.lastrowid
+
+    def journal_end(self, entry, outcome):
+        """Record the outcome of an operation.
+
+        This does not commit: it goes with the changes to the items, so
+        either both or none of them reach the disk.
+        """
+        cur = self.db.cursor()
+        cur.execute('UPDATE journal SET outcome = ? WHERE id = ?',
+                    (outcome, entry))
+
+    def journal_set_monitor(self, entry, monitor_url):
+        """Leave a copy that is still running in the journal, with the
+        URL to check its status later."""
+        cur = self.db.cursor()
+        cur.execute('UPDATE journal SET monitor_url = ? WHERE id = ?',
+                    (monitor_url, entry))
+        self.db.commit()
+
+    def has_pending_copy(self, original_path):
+        cur = self.db.cursor()
+        cur.execute('SELECT 1 FROM journal WHERE outcome IS NULL '
+                    'AND monitor_url IS NOT NULL AND original_path = ?',
+                    (original_path,))
+        return cur.fetchone() is not None
+
+    def journal_failed_attempt(self, entry):
+        cur = self.db.cursor()
+        cur.execute('UPDATE journal SET attempts = attempts + 1 '
+                    'WHERE id = ?', (entry,))
+        self.db.commit()
+
+    def get_pending_journal(self):
+        cur = self.db.cursor()
+        cur.execute('SELECT id, operation, onedrive_id, parent_id, '
+                    'original_path, monitor_url, attempts FROM journal '
+                    'WHERE outcome IS NULL ORDER BY id')
+        return cur.fetchall()
+
+    def prune_journal(self, older_than):
+        cur = self.db.cursor()
+        cur.execute('DELETE FROM journal WHERE outcome IS NOT NULL '
+                    'AND started < ?', (older_than,))
+
+    def get_maintenance(self):
+        cur = self.db.cursor()
+        cur.execute('SELECT task, last FROM maintenance')
+        return dict(cur.fetchall())
+
+    def set_maintenance(self, times):
+        cur = self.db.cursor()
+        cur.executemany('INSERT OR REPLACE INTO maintenance VALUES (?, ?)',
+                        times.items())
+        self.db.commit()
+
     def mark_not_existing(self):
         cur = self.db.cursor()
         cur.execute('UPDATE item SET existing = 0;')
@@ -1,6 +1,9 @@
 from recordclass import recordclass
 
 
+# recordclass instances have no __dict__ and are not tracked by the GC,
+# so they stay small even when we keep millions of them.
+# mdate is always expressed in seconds since the epoch, like in the DB.
 Item = recordclass(
     'Item',
     'onedrive_id name original_path existing is_folder size mdate hash '
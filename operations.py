@@ -5,10 +5,16 @@ from quickxorhash import quickxorhash
 
 import base64
 import logging
+import os.path
 import pathlib
+import time
 
 logger = logging.getLogger(__name__)
 
+# A copy costs a request to start it, at least one to check it and one to
+# set the times, so smaller files (a few upload chunks) are just uploaded
+COPY_MIN_SIZE = 32 << 20
+
 
 def quickxor_file(filename):
     h = quickxorhash()
@@ -23,13 +29,45 @@ def quickxor_file(filename):
     return base64.b64encode(h.digest()).decode()
 
 
+class HashVerifier:
+    """Decide which files to hash during a comparison.
+
+    candidates is a set of OneDrive IDs (None means every file), and
+    max_seconds limits the total time spent hashing in a cycle.
+    """
+
+    def __init__(self, db, candidates=None, max_seconds=None):
+        self.db = db
+        self.candidates = candidates
+        self.max_seconds = max_seconds
+        self.spent = 0
+
+    def wants(self, item):
+        if self.max_seconds is not None and self.spent >= self.max_seconds:
+            return False
+        return self.candidates is None or item.onedrive_id in self.candidates
+
+    def check(self, path, item):
+        start = time.monotonic()
+        hash_ = quickxor_file(str(path))
+        self.spent += time.monotonic() - start
+        if hash_ != item.hash:
+            # Marked only after a successful upload of the right version
+            return False
+        self.db.mark_hash_checked(item, time.time())
+        return True
+
+
 class Node:
 
     def __init__(self, path, item, db, client, parent_node=None):
         self.db = db
         self.client = client
         self.queries = 0
+        self.changes = 0
         self.parent_node = parent_node
+        # The name of the synchronized directory this node belongs to
+        self.root = parent_node.root if parent_node is not None else None
 
         if path is not None and not isinstance(path, pathlib.Path):
             path = pathlib.Path(path)
@@ -44,7 +82,7 @@ class Node:
         else:
             self.onedrive_path = ''
 
-    def act(self, check_hash=False):
+    def act(self, verifier=None):
         if self.path is not None and self.item is not None:
             logger.debug('Act: update %s, %s', self.path,
                          self.item.onedrive_id)
@@ -60,7 +98,7 @@ class Node:
 
             # Directories are always up to date
             if self.path.is_file():
-                self.update(check_hash)
+                self.update(verifier)
         elif self.path is not None:
             logger.debug('Act: create %s', self.path)
             self.create()
@@ -82,7 +120,7 @@ class Node:
         self.create()
         return False
 
-    def update(self, check_hash=False):
+    def update(self, verifier=None):
         if self.path is None or self.item is None:
             logger.error('Called update with None path or item')
             return False
@@ -93,12 +131,12 @@ class Node:
         mtime_window = 2
         stat = self.path.stat()
         updated = (stat.st_size == self.item.size
-                   and (abs(stat.st_mtime - self.item.mdate.timestamp())
+                   and (abs(stat.st_mtime - self.item.mdate)
                         < mtime_window))
 
-        if check_hash and updated:
-            hash_ = quickxor_file(str(self.path))
-            if hash_ != self.item.hash:
+        if updated and verifier is not None and verifier.wants(self.item):
+            self.queries += 1
+            if not verifier.check(self.path, self.item):
                 updated = False
                 logger.info('%s passed size and mtime check but not hash',
                             self.path)
@@ -115,15 +153,23 @@ class Node:
         logger.debug('Uploading new version of %s', self.path)
         parent_id = (self.parent_node.item.onedrive_id
                      if self.parent_node is not None else None)
-        new_item = self.client.upload(
+        entry = self.db.journal_begin(
+            'update', self.item.onedrive_id, parent_id, str(self.path))
+        new_item, verified = self.client.upload(
             str(self.path), self.item.onedrive_id, parent_id)
         if new_item is None:
             logger.error('Could not update %s', self.path)
+            self.db.journal_end(entry, 'failed')
             return False
 
         self.item = new_item
         self.db.update_items([new_item])
+        # upload checks that OneDrive received the same content we have
+        if verified:
+            self.db.mark_hash_checked(new_item, time.time())
+        self.db.journal_end(entry, 'done')
         self.queries += 1
+        self.changes += 1
         return True
 
     def create(self):
@@ -134,23 +180,47 @@ class Node:
                          'item (%s, %s)', self.path, self.item.onedrive_id)
             return False
 
+        if self.db.has_pending_copy(str(self.path)):
+            logger.info('Waiting for the copy of %s to complete', self.path)
+            return False
+
+        entry = self.db.journal_begin(
+            'create', None, parent_id, str(self.path))
+        # Folders have no hash, copies have the hash of their source
+        verified = True
         if self.path.is_dir():
             item = self.client.create_folder(parent_id, self.path.name)
         elif self.path.is_file():
-            target = self.parent_node.onedrive_path + '/' + self.path.name
-            item = self.client.upload(
-                str(self.path), target, self.parent_node.item.onedrive_id,
-                False)
+            try:
+                item = self.copy_duplicate()
+            except client.CopyPending as e:
+                # Uploading now might create a duplicate, so wait for the
+                # copy at the end of the comparison (see finish_copies)
+                self.db.journal_set_monitor(entry, e.monitor_url)
+                self.queries += 1
+                self.changes += 1
+                return False
+            if item is None:
+                target = self.parent_node.onedrive_path + '/' + self.path.name
+                item, verified = self.client.upload(
+                    str(self.path), target, self.parent_node.item.onedrive_id,
+                    False)
         else:
             logger.error('Tried to call create on something that is neither a '
                          'file nor a directory (%s)', self.path)
+            self.db.journal_end(entry, 'failed')
             return False
 
         if item is None:
             logger.error('Creation of %s failed', self.path)
+            self.db.journal_end(entry, 'failed')
             return False
         self.db.add_item(item)
+        if not item.is_folder and verified:
+            self.db.mark_hash_checked(item, time.time())
+        self.db.journal_end(entry, 'done')
         self.queries += 1
+        self.changes += 1
         self.item = item
 
         if self.parent_node is not None:
@@ -161,15 +231,37 @@ class Node:
 
         return True
 
+    def copy_duplicate(self):
+        """Try to create the item with a copy of an identical file that
+        is already on OneDrive."""
+        size = self.path.stat().st_size
+        # Hash only when there is a chance of finding a duplicate
+        if size < COPY_MIN_SIZE or not self.db.has_size(size):
+            return None
+        hash_ = quickxor_file(str(self.path))
+        for source in self.db.get_by_contents(size, hash_):
+            logger.debug('Copying %s from %s', self.path, source.onedrive_id)
+            # Do not wait, the copies run on the server in the meantime
+            item = self.client.copy(
+                str(self.path), source.onedrive_id,
+                self.parent_node.item.onedrive_id, self.path.name, False)
+            if item is not None:
+                return item
+        return None
+
     def delete(self):
         okay = False
+        entry = self.db.journal_begin(
+            'delete', self.item.onedrive_id, self.item.parent_id)
         if self.client.delete_item(self.item.onedrive_id):
             self.db.delete_items([self.item])
             self.queries += 1
+            self.changes += 1
             okay = True
         if not okay:
             logger.error('Could not delete %s (%s).', self.item.onedrive_id,
                          self.item.name)
+        self.db.journal_end(entry, 'done' if okay else 'failed')
         self.item = None
         return okay
 
@@ -278,15 +370,122 @@ class ChildrenLister:
 
 class Operations:
 
-    def __init__(self):
-        self.db = database.Database()
-        self.client = client.Client()
+    def __init__(self, profile=client.DEFAULT_PROFILE, adapter=None):
+        self.client = client.Client(profile, adapter)
+        self.db = database.Database(self.client.config['database'])
 
         # Get the drives, only to test the connection, raise any error,
         # if needed, or refresh the token with an easy request
         # a GET, without e.g. POST data
         self.client.get_drives()
 
+        self.recover_journal()
+
+    def recover_journal(self):
+        """Reconcile the items touched by operations interrupted by a
+        crash, so that the database matches OneDrive again."""
+        max_attempts = 5
+
+        pending = self.db.get_pending_journal()
+        if pending:
+            logger.info('Recovering %d interrupted operations', len(pending))
+
+        next_link = None
+        while pending:
+            (entry, operation, onedrive_id, parent_id, path, monitor_url,
+             attempts) = pending[0]
+            logger.debug('Recovering %s of %s (%s)', operation, path,
+                         onedrive_id)
+            outcome = 'recovered'
+            try:
+                if next_link:
+                    # Resume listing the children after throttling
+                    self.recover_children(parent_id, next_link)
+                elif monitor_url is not None:
+                    outcome = self.recover_copy(monitor_url, parent_id, path)
+                elif operation == 'create':
+                    self.recover_children(parent_id)
+                else:
+                    self.recover_item(onedrive_id)
+            except client.ThrottleError as e:
+                logger.debug('Throttle request: sleeping for %i',
+                             e.retry_after)
+                next_link = e.next_link
+                e.sleep()
+                continue
+            except Exception as e:
+                pending.pop(0)
+                next_link = None
+                if attempts + 1 < max_attempts:
+                    # Keep the entry, we will try again at the next run
+                    logger.error('Could not recover %s of %s', operation,
+                                 onedrive_id or path, exc_info=e)
+                    self.db.journal_failed_attempt(entry)
+                else:
+                    # Leave it to the next rebuild of the database
+                    logger.error('Giving up on recovering %s of %s',
+                                 operation, onedrive_id or path, exc_info=e)
+                    self.db.journal_end(entry, 'abandoned')
+                    self.db.commit()
+                continue
+
+            pending.pop(0)
+            next_link = None
+            if outcome is None:
+                # Still running, keep the entry
+                continue
+            self.db.journal_end(entry, outcome)
+            self.db.commit()
+
+        week_ago = time.time() - 7 * 86400
+        self.db.prune_journal(week_ago)
+        self.db.commit()
+
+    def recover_children(self, parent_id, next_link=None):
+        if parent_id is None:
+            return
+        # Any upload we do not know about is an orphan of the crash.
+        # Add it without a path, the children lister will match it by
+        # name, or delete it.
+        pages = self.client.get_children_pages(parent_id, next_link)
+        for children, _ in pages:
+            for item in children:
+                if self.db.get_item(item.onedrive_id) is None:
+                    item.parent_id = parent_id
+                    self.db.add_item(item)
+
+    def recover_copy(self, monitor_url, parent_id, path):
+        """Record a copy that took too long during a creation, and
+        return the outcome of the entry, or None if it is still running."""
+        status, new_id = self.client.check_copy(monitor_url)
+        if status == 'inProgress':
+            return None
+        if status == 'failed':
+            # Nothing was created: the next comparison uploads the file
+            return 'failed'
+        item = None
+        if status == 'completed' and os.path.exists(path):
+            item = self.client.finish_copy(path, new_id, parent_id)
+        if item is None:
+            # Find the copy, if any, by listing the parent
+            self.recover_children(parent_id)
+        elif self.db.get_item(item.onedrive_id) is None:
+            self.db.add_item(item)
+            self.db.mark_hash_checked(item, time.time())
+        return 'recovered'
+
+    def recover_item(self, onedrive_id):
+        old = self.db.get_item(onedrive_id)
+        if old is None:
+            return
+        item = self.client.get_item(onedrive_id)
+        if item is None:
+            self.db.delete_items([onedrive_id])
+            return
+        item.original_path = old.original_path
+        item.parent_id = old.parent_id
+        self.db.update_items([item])
+
     def populate_db(self):
         logger.info('Starting populating the database')
 
@@ -301,56 +500,112 @@ class Operations:
             self.db.add_update_item(item)
             if item.is_folder:
                 # Should always be the case for this kind of query
-                to_get.append(item.onedrive_id)
+                to_get.append((item.onedrive_id, None))
         self.db.commit()
 
         counter = 0
         while to_get:
-            parent_id = to_get[0]
+            parent_id, next_link = to_get[0]
             logger.debug('Populating children of %s', parent_id)
 
             try:
-                children = self.client.get_children(parent_id)
+                pages = self.client.get_children_pages(parent_id, next_link)
+                for children, _ in pages:
+                    for item in children:
+                        item.parent_id = parent_id
+                        self.db.add_update_item(item)
+                        if item.is_folder:
+                            to_get.append((item.onedrive_id, None))
+
+                        counter += 1
+                        if counter % commit_every_n == 0:
+                            self.db.commit()
             except client.ThrottleError as e:
                 logger.debug('Throttle request: sleeping for %i',
                              e.retry_after)
+                # Resume from the page that was throttled
+                to_get[0] = (parent_id, e.next_link)
                 e.sleep()
                 continue
 
             to_get.pop(0)
-            for item in children:
-                item.parent_id = parent_id
-                self.db.add_update_item(item)
-                if item.is_folder:
-                    to_get.append(item.onedrive_id)
-
-                counter += 1
-                if counter % commit_every_n == 0:
-                    self.db.commit()
 
         self.db.delete_not_existing()
         self.db.commit()
         self.db.vacuum()
 
-    def compare_trees(self, check_hash=False):
+    def get_hash_verifier(self, max_bytes, max_seconds=None,
+                          prioritize_modified=False):
+        candidates = self.db.get_hash_candidates(
+            max_bytes, prioritize_modified)
+        logger.info('Verifying the hashes of %d files', len(candidates))
+        return HashVerifier(self.db, candidates, max_seconds)
+
+    def compare_trees(self, verifier=None):
+        """Mirror the local trees, and return the number of changes done
+        in each synchronized directory."""
         save_every_n = 1000
 
         to_work = []
+        changes = {}
         for name, dir_ in self.client.config['synchronize'].items():
-            to_work.append(Node(
+            node = Node(
                 pathlib.Path(dir_),
                 self.db.get_from_root(name),
                 self.db,
-                self.client))
+                self.client)
+            node.root = name
+            to_work.append(node)
+            changes[name] = 0
 
         unsaved = 0
         while to_work:
             node = to_work.pop()
-            node.act(check_hash)
+            node.act(verifier)
             to_work = node.get_children() + to_work
+            changes[node.root] += node.changes
 
             unsaved += node.queries
             if unsaved > save_every_n:
                 self.db.commit()
                 logger.debug('Committing (%d unsaved)', unsaved)
                 unsaved = 0
+
+        self.finish_copies()
+        return changes
+
+    def finish_copies(self, timeout=60):
+        """Wait for the copies started during the comparison, checking all
+        of them at each poll.
+
+        The copies still running after timeout seconds are checked again
+        by the recovery of the next run.
+        """
+        deadline = time.monotonic() + timeout
+        poll = 1
+        failed = set()
+        while True:
+            pending = [row for row in self.db.get_pending_journal()
+                       if row[5] is not None and row[0] not in failed]
+            if not pending or time.monotonic() >= deadline:
+                break
+            time.sleep(poll)
+            poll = min(poll * 2, 30)
+            for entry, _, _, parent_id, path, monitor_url, _ in pending:
+                try:
+                    outcome = self.recover_copy(monitor_url, parent_id, path)
+                except client.ThrottleError as e:
+                    poll = max(poll, e.retry_after)
+                    break
+                except Exception as e:
+                    # The recovery counts the attempts and gives up
+                    logger.warning('Could not check the copy of %s', path,
+                                   exc_info=e)
+                    failed.add(entry)
+                    continue
+                if outcome is not None:
+                    self.db.journal_end(entry, outcome)
+                    self.db.commit()
+        if pending:
+            logger.info('%d copies still running, checking them at the '
+                        'next run', len(pending))
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+import logging
+import random
+import sys
+import time
+
+logger = logging.getLogger(__name__)
+
+# Heavy maintenance tasks, and how often we want to run them
+MAINTENANCE_PERIODS = {
+    # The journal keeps the database consistent, so the full rebuild only
+    # catches changes done on OneDrive by others
+    'rebuild': 30 * 86400,
+    'vacuum': 86400,
+}
+# How long we expect them to take, until we measure them
+MAINTENANCE_ESTIMATES = {
+    'rebuild': 3 * 3600,
+    'vacuum': 600,
+}
+
+
+def ewma(old, new, alpha=0.3):
+    if old is None:
+        return new
+    return alpha * new + (1 - alpha) * old
+
+
+class Scheduler:
+    """Choose when to run the next cycle and what to do during it.
+
+    We try to mirror any change within freshness_target seconds, keeping
+    margin of it free for variations in the duration of cycles. A change
+    done just after the previous cycle looked at its file is mirrored at
+    the end of the next cycle, so the previous cycle, the sleep and the
+    next cycle must fit in the target. We predict the duration of the
+    next cycle from the time needed to scan the trees, and from the
+    observed change rate and the time each change costs.
+
+    Heavy maintenance runs when it is due, with a shorter sleep before
+    it (even shorter than min_interval) so that it still fits in the
+    target, after a cycle without hashing if needed. If it does not fit
+    anyway, it is postponed, unless it is late by more than grace times
+    its period. Hash verification gets the time that keeps the
+    service busy for at most max_duty of the time.
+
+    With relax_when_quiet, when we do not expect any change within the
+    target we relax up to max_interval. After failures we back off
+    exponentially, from fail_sleep up to max_fail_sleep.
+    """
+
+    def __init__(self, freshness_target=4 * 3600, min_interval=600,
+                 max_interval=12 * 3600, max_duty=0.25, fail_sleep=300,
+                 max_fail_sleep=6 * 3600, min_hash_seconds=300,
+                 max_hash_seconds=3600, grace=0.25, margin=0.1,
+                 relax_when_quiet=False, clock=time.time):
+        self.freshness_target = freshness_target
+        self.margin = margin
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.max_duty = max_duty
+        self.fail_sleep = fail_sleep
+        self.max_fail_sleep = max_fail_sleep
+        self.min_hash_seconds = min_hash_seconds
+        self.max_hash_seconds = max_hash_seconds
+        self.grace = grace
+        self.relax_when_quiet = relax_when_quiet
+        self.clock = clock
+
+        # Changes per second, for each synchronized directory
+        self.rates = {}
+        # Seconds to compare the trees without changes, and for each change
+        self.scan = None
+        self.change_cost = 0
+        self.last_duration = None
+        self.task_durations = dict(MAINTENANCE_ESTIMATES)
+        self.failures = 0
+        self.last_cycle = None
+        # What we decided to do in the next cycle
+        self.planned_task = None
+        self.planned_hash = min_hash_seconds
+        # Without a record of the previous runs (see restore), avoid doing
+        # long operations when starting, postpone them to their next period
+        now = clock()
+        self.last_maintenance = {task: now for task in MAINTENANCE_PERIODS}
+
+    def restore(self, times):
+        """Load when the maintenance tasks ran last, e.g. before a
+        restart of the service."""
+        for task in MAINTENANCE_PERIODS:
+            if task in times:
+                self.last_maintenance[task] = times[task]
+
+    def change_rate(self):
+        return sum(self.rates.values())
+
+    def most_overdue(self, when):
+        """Return the most overdue maintenance task at the given time, and
+        how late it is, relatively to its period."""
+        best = None
+        best_ratio = 1
+        for task, period in MAINTENANCE_PERIODS.items():
+            ratio = (when - self.last_maintenance[task]) / period
+            if ratio >= best_ratio:
+                best = task
+                best_ratio = ratio
+        return best, best_ratio
+
+    def next_maintenance(self):
+        """Return the maintenance task to do in this cycle, if any.
+
+        Only one heavy task is done in each cycle, to keep the duration
+        of cycles predictable.
+        """
+        task, ratio = self.most_overdue(self.clock())
+        if self.last_duration is None:
+            # We could not plan yet, so run only what cannot wait
+            return task if ratio >= 1 + self.grace else None
+        if task is not None and task == self.planned_task:
+            return task
+        return None
+
+    def maintenance_done(self, task, duration):
+        now = self.clock()
+        self.last_maintenance[task] = now
+        if task == 'rebuild':
+            # The rebuild also vacuums the database
+            self.last_maintenance['vacuum'] = now
+        self.task_durations[task] = ewma(
+            self.task_durations.get(task), duration)
+        self.planned_task = None
+
+    def hash_seconds(self):
+        """Return the time we can spend verifying hashes in this cycle."""
+        return self.planned_hash
+
+    def predict_work(self, interval):
+        """Predict how long the next cycle takes to compare the trees,
+        without hashing and maintenance."""
+        changes = self.change_rate() * (self.last_duration + interval)
+        return self.scan + self.change_cost * changes
+
+    def interval_for(self, hashing, maintenance=0, last_duration=None):
+        """Return the longest sleep that still mirrors changes within the
+        target, when the next cycle also spends time on hashing and on
+        maintenance."""
+        if last_duration is None:
+            last_duration = self.last_duration
+        # The work of the next cycle grows with the time that passes before
+        # we compare the trees, because more changes accumulate: solve for
+        # the interval
+        cost_rate = self.change_cost * self.change_rate()
+        target = self.freshness_target * (1 - self.margin)
+        fit = (target - last_duration - self.scan - hashing - maintenance
+               - cost_rate * (last_duration + maintenance))
+        return fit / (1 + cost_rate)
+
+    def plan(self, now):
+        """Decide the next cycle, and return the seconds to sleep."""
+        target = self.freshness_target * (1 - self.margin)
+        # In a steady state, a cycle lasting this long, repeated within
+        # the target, keeps us busy for max_duty of the time
+        duty_cycle = target * self.max_duty / (1 + self.max_duty)
+        steady_work = self.predict_work(target - 2 * duty_cycle)
+        hashing = max(self.min_hash_seconds,
+                      min(self.max_hash_seconds, duty_cycle - steady_work))
+
+        interval = self.interval_for(hashing)
+        if interval < self.min_interval:
+            # Hash less, rather than missing the target
+            cost_rate = self.change_cost * self.change_rate()
+            hashing = max(self.min_hash_seconds, hashing
+                          - (self.min_interval - interval) * (1 + cost_rate))
+            interval = self.interval_for(hashing)
+
+        self.planned_task = None
+        task, ratio = self.most_overdue(now + max(interval, 0))
+        if task is not None:
+            cost = self.task_durations[task]
+            with_task = self.interval_for(self.min_hash_seconds, cost)
+            # A light cycle, without hashing, might make room for the task
+            light = self.predict_work(interval) + self.min_hash_seconds
+            after_light = self.interval_for(self.min_hash_seconds, cost,
+                                            light)
+            # The sleep before a maintenance can be shorter than usual
+            if with_task >= 0 or ratio >= 1 + self.grace:
+                self.planned_task = task
+                hashing = self.min_hash_seconds
+                interval = with_task
+            elif after_light >= 0:
+                logger.info('Preparing for %s with a light cycle', task)
+                hashing = self.min_hash_seconds
+                interval = self.interval_for(hashing)
+            else:
+                logger.info('Postponing %s, it does not fit in the '
+                            'freshness target', task)
+
+        if (self.relax_when_quiet and self.planned_task is None
+                and self.change_rate() * target < 1):
+            # Less than a change expected within the target: relax
+            interval = self.max_interval
+
+        self.planned_hash = hashing
+        if self.planned_task is not None:
+            return max(0, min(self.max_interval, interval))
+        return max(self.min_interval, min(self.max_interval, interval))
+
+    def cycle_done(self, changes, duration, hashing=0, maintenance=0):
+        """Record a successful cycle and return the seconds to sleep.
+
+        hashing and maintenance are the parts of duration spent verifying
+        hashes and doing the maintenance task.
+        """
+        now = self.clock()
+        if self.last_cycle is not None:
+            elapsed = max(now - self.last_cycle, 1)
+            for root, count in changes.items():
+                self.rates[root] = ewma(self.rates.get(root), count / elapsed)
+        for root in list(self.rates):
+            if root not in changes:
+                del self.rates[root]
+
+        # Split the work in the scan of the trees and the changes
+        work = max(0, duration - hashing - maintenance)
+        count = sum(changes.values())
+        if self.scan is None:
+            self.scan = work
+        else:
+            if count:
+                self.change_cost = ewma(
+                    self.change_cost, max(0, work - self.scan) / count)
+            self.scan = ewma(self.scan,
+                             max(0, work - self.change_cost * count))
+
+        self.last_cycle = now
+        self.last_duration = duration
+        self.failures = 0
+
+        interval = self.plan(now)
+        logger.info('Cycle done in %ds with %d changes, next in %ds '
+                    '(task=%s, hashing=%ds)', duration, count, interval,
+                    self.planned_task, self.planned_hash)
+        return interval
+
+    def failed(self):
+        """Record a failed cycle and return the seconds to sleep."""
+        self.failures += 1
+        delay = min(self.max_fail_sleep,
+                    self.fail_sleep * 2 ** (self.failures - 1))
+        logger.info('Cycle failed %d times in a row, retrying in %ds',
+                    self.failures, delay)
+        return delay
+
+
+def poisson(rng, mean):
+    """Return how many of the changes that arrive independently, mean on
+    average, happened."""
+    count = 0
+    elapsed = rng.expovariate(1)
+    while elapsed < mean:
+        count += 1
+        elapsed += rng.expovariate(1)
+    return count
+
+
+def simulate(days=60, rates=None, seconds_per_change=5, base_duration=600,
+             task_costs=None, failure_rate=0, seed=0, **kwargs):
+    """Dry-run the scheduler with a virtual clock, and print its choices.
+
+    rates are the changes per hour of each synchronized directory.
+    Failures always delay the changes, so they are disabled by default.
+    """
+    if rates is None:
+        rates = {'Directory1': 2, 'Directory2': 0.1}
+    if task_costs is None:
+        task_costs = {'rebuild': 3 * 3600, 'vacuum': 300}
+    rng = random.Random(seed)
+    now = [0.0]
+    scheduler = Scheduler(clock=lambda: now[0], **kwargs)
+
+    busy = 0
+    worst = 0
+    missed = 0
+    cycles = 0
+    last_run = 0
+    while now[0] < days * 86400:
+        start = now[0]
+        task = scheduler.next_maintenance()
+        maintenance = 0
+        if task is not None:
+            maintenance = task_costs[task]
+            now[0] += maintenance
+            scheduler.maintenance_done(task, maintenance)
+        hashing = scheduler.hash_seconds()
+
+        if rng.random() < failure_rate:
+            now[0] += base_duration / 2
+            busy += now[0] - start
+            delay = scheduler.failed()
+            print('{:9.2f}h failed, sleeping {:.2f}h'.format(
+                start / 3600, delay / 3600))
+            now[0] += delay
+            continue
+
+        elapsed = now[0] - last_run
+        changes = {root: poisson(rng, rate * elapsed / 3600)
+                   for root, rate in rates.items()}
+        now[0] += (base_duration + hashing
+                   + seconds_per_change * sum(changes.values()))
+        # A change done just after the previous cycle started
+        staleness = now[0] - last_run
+        worst = max(worst, staleness)
+        cycles += 1
+        if staleness > scheduler.freshness_target:
+            missed += 1
+        last_run = start
+        busy += now[0] - start
+        delay = scheduler.cycle_done(changes, now[0] - start, hashing,
+                                     maintenance)
+        print('{:9.2f}h task={} hashing={:.0f}s changes={} next in {:.2f}h'
+              .format(start / 3600, task, hashing, sum(changes.values()),
+                      delay / 3600))
+        now[0] += delay
+
+    print('Duty cycle: {:.1%}, worst staleness: {:.2f}h (target {:.2f}h), '
+          'cycles over the target: {}/{}'.format(
+              busy / now[0], worst / 3600,
+              scheduler.freshness_target / 3600, missed, cycles))
+
+
+if __name__ == '__main__':
+    simulate(int(sys.argv[1]) if len(sys.argv) > 1 else 60)
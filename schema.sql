@@ -10,7 +10,31 @@ CREATE TABLE IF NOT EXISTS item (
 	mdate REAL,
 	hash TEXT,
 	parent_id TEXT,
+	hash_checked REAL DEFAULT 0 NOT NULL,
 	FOREIGN KEY(parent_id) REFERENCES item(onedrive_id) ON UPDATE CASCADE ON DELETE CASCADE
 );
 
 CREATE INDEX parents ON item(parent_id);
+CREATE INDEX hash_checked ON item(hash_checked);
+CREATE INDEX contents ON item(size, hash);
+
+-- Remote operations, recorded before doing them, to recover from crashes
+CREATE TABLE IF NOT EXISTS journal (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	operation TEXT NOT NULL,
+	onedrive_id TEXT,
+	parent_id TEXT,
+	original_path TEXT,
+	started REAL NOT NULL,
+	outcome TEXT,
+	monitor_url TEXT,
+	attempts INTEGER DEFAULT 0 NOT NULL
+);
+
+CREATE INDEX pending ON journal(outcome);
+
+-- When each maintenance task ran last, to survive restarts
+CREATE TABLE IF NOT EXISTS maintenance (
+	task TEXT PRIMARY KEY,
+	last REAL NOT NULL
+);
@@ -1,76 +1,115 @@
 #!/usr/bin/env python3
+import client
 from operations import Operations
+from scheduler import Scheduler, simulate
 
-from datetime import datetime
+import concurrent.futures
 import sys
 import time
 
 
-def get_week():
-    # Start from Sunday so long operations that we do weekly start on
-    # Sundays
-    return int(datetime.now().strftime('%U'))
+def cycle(profile, scheduler, adapter, interval):
+    """Mirror the directories of a profile once.
 
+    Return the seconds to wait before the next cycle, and the interval
+    to use to size the hash verification of the next cycle.
+    """
+    # Verify all the hashes every 3 days, a slice at each run
+    hashes_period = 3 * 86400
+    hashes_min_bytes = 1 << 30  # But at least 1 GiB per run
+    hashes_prioritize_modified = True
 
-def get_day():
-    return int(datetime.now().strftime('%j'))
-
-
-def service():
-    repeat_interval = 4 * 3600  # Run every 4 hours
-    hashes_frequency = 3  # Check hashes every 3 days
-    fail_sleep = 1800  # If failed, sleep for half an hour
-
-    # Avoid doing long operations when starting the service, postpone
-    # them to the next iteration
-    db_recreated = get_week()
-    hashes_checked = get_day()
-    last_vacuum = get_day() - 1
-
-    while True:
+    start = time.time()
+    task = None
+    try:
         # Notice that we recreate each time a new instance: in this way
         # we are sure that the Oauth session is refreshed at each run,
         # which should resolve some problems that I encountered
         # originally, when I created a single client before the while
-        o = Operations()
+        o = Operations(profile, adapter)
 
-        today = get_day()
-        this_week = get_week()
+        # The database keeps the maintenance times across restarts; a
+        # new database starts counting from now
+        scheduler.restore(o.db.get_maintenance())
+        o.db.set_maintenance(scheduler.last_maintenance)
 
-        if last_vacuum != today:
+        task = scheduler.next_maintenance()
+        maintenance = time.time()
+        if task == 'vacuum':
             o.db.vacuum()
-            last_vacuum = today
-
-        try:
-            if db_recreated != this_week:
-                o.populate_db()
-                db_recreated = this_week
-        except:
-            # You should think to something more clever
-            print('Something failed', sys.exc_info())
-            time.sleep(fail_sleep)
-            continue
-
-        check_hashes = (today - hashes_checked) > hashes_frequency
-
-        try:
-            o.compare_trees(check_hashes)
-        except:
-            # As above
-            print('Something failed', sys.exc_info())
-            time.sleep(fail_sleep)
-            continue
-
-        if check_hashes:
-            hashes_checked = today
-
+        elif task == 'rebuild':
+            o.populate_db()
+        maintenance = time.time() - maintenance
+        if task is not None:
+            scheduler.maintenance_done(task, maintenance)
+            o.db.set_maintenance(scheduler.last_maintenance)
+
+        hashes_bytes = max(
+            hashes_min_bytes,
+            o.db.get_total_size() * interval // hashes_period)
+        verifier = o.get_hash_verifier(
+            hashes_bytes, scheduler.hash_seconds(),
+            hashes_prioritize_modified)
+        changes = o.compare_trees(verifier)
         o.db.commit()
+        o.db.close()
+    except:
+        # You should think to something more clever
+        print('Something failed in profile', profile, sys.exc_info())
+        return scheduler.failed(), interval
+
+    interval = scheduler.cycle_done(
+        changes, time.time() - start, verifier.spent, maintenance)
+    return interval, interval
 
-        # We could check the start time, but some operations, like
-        # database population are very slow. In that case, just
-        # wait the usual time.
-        time.sleep(repeat_interval)
+
+def service():
+    config = client.load_config()
+    profiles = sorted(client.get_profiles(config))
+    # Profiles share the connections, and run in parallel up to this
+    workers = min(len(profiles), config.get('workers', 2))
+    adapter = client.make_adapter(2 * workers)
+
+    schedulers = {name: Scheduler() for name in profiles}
+    intervals = {name: schedulers[name].freshness_target
+                 for name in profiles}
+    next_run = {name: time.time() for name in profiles}
+    running = {}
+
+    with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+        while True:
+            # Start the profiles that waited longer first, so a busy
+            # profile cannot starve the others
+            now = time.time()
+            due = sorted((t, name) for name, t in next_run.items()
+                         if t <= now and name not in running)
+            for _, name in due[:workers - len(running)]:
+                running[name] = executor.submit(
+                    cycle, name, schedulers[name], adapter, intervals[name])
+
+            waiting = [t for name, t in next_run.items()
+                       if name not in running]
+            if waiting and len(running) < workers:
+                timeout = max(0, min(waiting) - now)
+            else:
+                # Wait for a worker to become free
+                timeout = None
+            if running:
+                concurrent.futures.wait(
+                    running.values(), timeout,
+                    concurrent.futures.FIRST_COMPLETED)
+            else:
+                time.sleep(timeout)
+
+            for name, future in list(running.items()):
+                if future.done():
+                    del running[name]
+                    delay, intervals[name] = future.result()
+                    next_run[name] = time.time() + delay
 
 
 if __name__ == '__main__':
-    service()
+    if '--dry-run' in sys.argv:
+        simulate()
+    else:
+        service()